@@ -2,9 +2,13 @@ from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
 import os
+import re
+import math
+import time
 from datetime import datetime, timedelta
 from typing import Optional, List
 from pydantic import BaseModel, EmailStr
@@ -38,6 +42,7 @@ leave_types_collection = db.leave_types
 leave_requests_collection = db.leave_requests
 expense_categories_collection = db.expense_categories
 expense_requests_collection = db.expense_requests
+expense_totals_collection = db.expense_totals
 attendance_collection = db.attendance
 holidays_collection = db.holidays
 
@@ -48,6 +53,10 @@ JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-here')
 JWT_ALGORITHM = os.environ.get('JWT_ALGORITHM', 'HS256')
 JWT_ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get('JWT_ACCESS_TOKEN_EXPIRE_MINUTES', '30'))
 
+# Expense counter rebuilds
+EXPENSE_REBUILD_LEASE = timedelta(seconds=int(os.environ.get('EXPENSE_REBUILD_LEASE_SECONDS', '60')))
+EXPENSE_REBUILD_SETTLE_SECONDS = 5
+
 # Upload directory
 UPLOAD_DIR = Path(os.environ.get('UPLOAD_DIR', './uploads'))
 UPLOAD_DIR.mkdir(exist_ok=True)
@@ -136,9 +145,201 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         raise credentials_exception
     return user
 
+def normalize_expense_date(expense_date: str):
+    # Expense dates are stored as "YYYY-MM-DD" so the first 7 characters are the month key
+    try:
+        return datetime.strptime(expense_date, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="expense_date must be in YYYY-MM-DD format")
+
+def get_expense_month(expense_date: str):
+    # Month key ("YYYY-MM") used to bucket expenses against monthly caps.
+    # Must match the $substrBytes key built in rebuild_expense_counters.
+    return expense_date[:7]
+
+def expense_counter_unlocked():
+    # Matches counters that are not locked by a live rebuild; locks whose
+    # lease has expired belong to a rebuild that died and are ignored
+    return {"$or": [
+        {"rebuild_id": None},
+        {"rebuild_started_at": {"$lt": datetime.utcnow() - EXPENSE_REBUILD_LEASE}}
+    ]}
+
+def apply_expense_total_delta(user_id: str, category_id: str, month: str, committed: float, approved: float, max_amount: Optional[float]):
+    # Atomically adjust the per-user/category/month running totals.
+    # "committed" tracks pending + approved amounts, "approved" only approved ones.
+    # Increments are a single guarded upsert so neither total can exceed the
+    # category cap; returns False if the guard rejected the update.
+    # Any change to a counter locked by a running rebuild fails with a 409.
+    key = {"user_id": user_id, "category_id": category_id, "month": month}
+    guard = {**key, **expense_counter_unlocked()}
+    
+    if committed <= 0 and approved <= 0:
+        # Clamp at zero, and leave untracked counters alone rather than creating
+        # them with negative totals
+        result = expense_totals_collection.update_one(
+            guard,
+            [{"$set": {
+                "committed_amount": {"$max": [0, {"$add": ["$committed_amount", committed]}]},
+                "approved_amount": {"$max": [0, {"$add": ["$approved_amount", approved]}]},
+                "updated_at": datetime.utcnow()
+            }}]
+        )
+        if result.matched_count == 1:
+            return True
+    else:
+        if max_amount is not None and (committed > max_amount or approved > max_amount):
+            return False
+        
+        if max_amount is not None:
+            if committed > 0:
+                guard["committed_amount"] = {"$lte": max_amount - committed}
+            if approved > 0:
+                guard["approved_amount"] = {"$lte": max_amount - approved}
+        update = {
+            "$inc": {"committed_amount": committed, "approved_amount": approved},
+            "$set": {"updated_at": datetime.utcnow()}
+        }
+        
+        # Only reserving new money may create a counter; approving a pending expense
+        # on a missing counter means the expense predates the counters
+        try:
+            result = expense_totals_collection.update_one(guard, update, upsert=committed > 0)
+            if result.matched_count == 1 or result.upserted_id is not None:
+                return True
+        except DuplicateKeyError:
+            # The counter exists but failed the guard, or another request created it first
+            result = expense_totals_collection.update_one(guard, update)
+            if result.matched_count == 1:
+                return True
+    
+    counter = expense_totals_collection.find_one(key)
+    if counter is None:
+        return True
+    if counter.get("rebuild_id") or (committed <= 0 and approved <= 0):
+        raise HTTPException(status_code=409, detail="Expense limits are being recalculated, please retry")
+    return False
+
+def rebuild_expense_counter(key: dict, rebuild_id: str):
+    # Recompute a single counter from its expenses. Returns "rebuilt",
+    # "removed", or None if another live rebuild holds the counter.
+    lock = {"$set": {"rebuild_id": rebuild_id, "rebuild_started_at": datetime.utcnow()}}
+    try:
+        result = expense_totals_collection.update_one(
+            {**key, **expense_counter_unlocked()},
+            {**lock, "$setOnInsert": {"committed_amount": 0, "approved_amount": 0}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Either locked by another rebuild or created by a submission just now
+        result = expense_totals_collection.update_one({**key, **expense_counter_unlocked()}, lock)
+        if result.matched_count == 0:
+            return None
+    
+    # With the counter locked no counter change can succeed, so wait for requests
+    # that already moved it to record their counted_status. Requests stuck for
+    # longer (e.g. their process died) are settled by their stored status, and
+    # rows from before the counters existed are settled straight away.
+    expense_filter = {
+        "user_id": key["user_id"],
+        "category_id": key["category_id"],
+        "expense_date": {"$regex": "^" + re.escape(key["month"])}
+    }
+    deadline = time.monotonic() + EXPENSE_REBUILD_SETTLE_SECONDS
+    while True:
+        expenses = [
+            expense for expense in expense_requests_collection.find(expense_filter)
+            if get_expense_month(expense["expense_date"]) == key["month"]
+        ]
+        unsettled = [expense for expense in expenses if expense.get("counted_status") != expense["status"]]
+        if not unsettled:
+            break
+        
+        timed_out = time.monotonic() >= deadline
+        waiting = False
+        for expense in unsettled:
+            if "counted_status" in expense and not timed_out:
+                waiting = True
+                continue
+            expense_requests_collection.update_one(
+                {"request_id": expense["request_id"], "status": expense["status"],
+                 "counted_status": expense.get("counted_status")},
+                {"$set": {"counted_status": expense["status"]}}
+            )
+        if waiting:
+            time.sleep(0.1)
+    
+    committed_amount = sum(e["amount"] for e in expenses if e["counted_status"] in ["pending", "approved"])
+    approved_amount = sum(e["amount"] for e in expenses if e["counted_status"] == "approved")
+    
+    # Only write back while the lease still holds, otherwise the counter may
+    # already have moved on without us
+    owned = {**key, "rebuild_id": rebuild_id,
+             "rebuild_started_at": {"$gte": datetime.utcnow() - EXPENSE_REBUILD_LEASE}}
+    if committed_amount == 0 and approved_amount == 0:
+        result = expense_totals_collection.delete_one(owned)
+        return "removed" if result.deleted_count == 1 else None
+    
+    result = expense_totals_collection.update_one(
+        owned,
+        {
+            "$set": {
+                "committed_amount": committed_amount,
+                "approved_amount": approved_amount,
+                "updated_at": datetime.utcnow()
+            },
+            "$unset": {"rebuild_id": "", "rebuild_started_at": ""}
+        }
+    )
+    return "rebuilt" if result.matched_count == 1 else None
+
+def rebuild_expense_counters():
+    # Recompute the monthly running totals from the expense history, one
+    # counter at a time. Each counter is locked only while it is recomputed,
+    # so submissions for other users/categories/months carry on meanwhile.
+    # Counters another live rebuild is working on are skipped.
+    rebuild_id = str(uuid.uuid4())
+    keys = {}
+    for counter in expense_totals_collection.find({}, {"_id": 0, "user_id": 1, "category_id": 1, "month": 1}):
+        keys[(counter["user_id"], counter["category_id"], counter["month"])] = counter
+    for item in expense_requests_collection.aggregate([
+        {"$group": {"_id": {
+            "user_id": "$user_id",
+            "category_id": "$category_id",
+            "month": {"$substrBytes": ["$expense_date", 0, 7]}
+        }}}
+    ]):
+        keys[(item["_id"]["user_id"], item["_id"]["category_id"], item["_id"]["month"])] = item["_id"]
+    
+    results = {"rebuilt": 0, "removed": 0, "skipped": 0}
+    for key in keys.values():
+        outcome = rebuild_expense_counter(key, rebuild_id)
+        results[outcome or "skipped"] += 1
+    return results
+
 # Initialize default data
 @app.on_event("startup")
 async def startup_event():
+    expense_totals_collection.create_index(
+        [("user_id", ASCENDING), ("category_id", ASCENDING), ("month", ASCENDING)],
+        unique=True
+    )
+    
+    expense_requests_collection.create_index(
+        [("user_id", ASCENDING), ("category_id", ASCENDING), ("expense_date", ASCENDING)]
+    )
+    
+    # Build the expense counters for expenses they do not cover yet (rows from
+    # before the counters existed, or requests whose process died half-way),
+    # and redo counters left behind by a rebuild whose lease has expired
+    expired_lock = expense_totals_collection.find_one({
+        "rebuild_id": {"$ne": None},
+        "rebuild_started_at": {"$lt": datetime.utcnow() - EXPENSE_REBUILD_LEASE}
+    })
+    unsettled = expense_requests_collection.find_one({"$expr": {"$ne": ["$status", "$counted_status"]}})
+    if expired_lock or unsettled:
+        rebuild_expense_counters()
+    
     # Create default admin user if not exists
     if not users_collection.find_one({"email": "admin@company.com"}):
         admin_user = {
@@ -400,14 +601,20 @@ async def submit_expense(expense_request: ExpenseRequest, current_user: dict = D
     if not category:
         raise HTTPException(status_code=404, detail="Expense category not found")
     
+    if not math.isfinite(expense_request.amount) or expense_request.amount <= 0:
+        raise HTTPException(status_code=400, detail="Amount must be a positive number")
+    
+    expense_date = normalize_expense_date(expense_request.expense_date)
+    
     expense_doc = {
         "request_id": request_id,
         "user_id": current_user["user_id"],
         "category_id": expense_request.category_id,
         "amount": expense_request.amount,
-        "expense_date": expense_request.expense_date,
+        "expense_date": expense_date,
         "description": expense_request.description,
         "status": "pending",
+        "counted_status": None,
         "manager_id": expense_request.manager_id,
         "submitted_at": datetime.utcnow(),
         "approved_at": None,
@@ -415,7 +622,25 @@ async def submit_expense(expense_request: ExpenseRequest, current_user: dict = D
         "receipt_url": None
     }
     
+    # Record the request first and then reserve the amount against the monthly
+    # cap. counted_status says which status the counters reflect; it stays None
+    # until the reservation lands, and the request is removed again if it fails.
     expense_requests_collection.insert_one(expense_doc)
+    try:
+        reserved = apply_expense_total_delta(current_user["user_id"], category["category_id"],
+                                             get_expense_month(expense_date), expense_request.amount, 0,
+                                             category.get("max_amount_per_month"))
+    except Exception:
+        expense_requests_collection.delete_one({"request_id": request_id, "counted_status": None})
+        raise
+    if not reserved:
+        expense_requests_collection.delete_one({"request_id": request_id, "counted_status": None})
+        raise HTTPException(status_code=400, detail=f"Monthly limit of {category['max_amount_per_month']} exceeded for {category['name']}")
+    
+    expense_requests_collection.update_one(
+        {"request_id": request_id, "counted_status": None},
+        {"$set": {"counted_status": "pending"}}
+    )
     return {"message": "Expense request submitted successfully", "request_id": request_id}
 
 @app.get("/api/expense/requests")
@@ -450,19 +675,65 @@ async def update_expense_request(request_id: str, status: str, current_user: dic
     if status not in ["approved", "rejected"]:
         raise HTTPException(status_code=400, detail="Status must be 'approved' or 'rejected'")
     
+    expense = expense_requests_collection.find_one({"request_id": request_id})
+    if not expense:
+        raise HTTPException(status_code=404, detail="Expense request not found")
+    
+    # A request whose last change has not reached the counters yet can't move on
+    previous_status = expense["status"]
+    if expense.get("counted_status") != previous_status:
+        raise HTTPException(status_code=409, detail="Expense request is still being processed, please retry")
+    
+    # Work out how this status change moves the committed/approved totals
+    amount = expense["amount"]
+    was_committed = previous_status != "rejected"
+    is_committed = status != "rejected"
+    committed_delta = (int(is_committed) - int(was_committed)) * amount
+    approved_delta = (int(status == "approved") - int(previous_status == "approved")) * amount
+    
     update_data = {
         "status": status,
         "approved_by": current_user["user_id"],
         "approved_at": datetime.utcnow()
     }
     
+    # Only apply the change if nobody else updated the request in the meantime.
+    # The status is switched before the counters move, and counted_status only
+    # follows once they have, so no later change can start in between. If the
+    # counter update is refused the status is switched back. A crash in between
+    # leaves the request blocked until the next rebuild settles it.
     result = expense_requests_collection.update_one(
-        {"request_id": request_id},
+        {"request_id": request_id, "status": previous_status, "counted_status": previous_status},
         {"$set": update_data}
     )
     
     if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Expense request not found")
+        raise HTTPException(status_code=409, detail="Expense request was modified concurrently, please retry")
+    
+    if committed_delta != 0 or approved_delta != 0:
+        category = expense_categories_collection.find_one({"category_id": expense["category_id"]})
+        max_amount = category.get("max_amount_per_month") if category else None
+        revert_filter = {"request_id": request_id, "status": status, "counted_status": previous_status}
+        revert_data = {
+            "status": previous_status,
+            "approved_by": expense.get("approved_by"),
+            "approved_at": expense.get("approved_at")
+        }
+        try:
+            applied = apply_expense_total_delta(expense["user_id"], expense["category_id"],
+                                                get_expense_month(expense["expense_date"]),
+                                                committed_delta, approved_delta, max_amount)
+        except Exception:
+            expense_requests_collection.update_one(revert_filter, {"$set": revert_data})
+            raise
+        if not applied:
+            expense_requests_collection.update_one(revert_filter, {"$set": revert_data})
+            raise HTTPException(status_code=400, detail=f"Approving this request would exceed the monthly limit of {max_amount}")
+    
+    expense_requests_collection.update_one(
+        {"request_id": request_id, "status": status, "counted_status": previous_status},
+        {"$set": {"counted_status": status}}
+    )
     
     return {"message": f"Expense request {status} successfully"}
 
@@ -658,6 +929,20 @@ async def delete_leave_type(type_id: str, current_user: dict = Depends(get_curre
     
     return {"message": "Leave type deleted successfully"}
 
+# Plain def so the (blocking) rebuild runs in the threadpool
+@app.post("/api/admin/expense-totals/rebuild")
+def rebuild_expense_totals(current_user: dict = Depends(get_current_user)):
+    if current_user["role"] not in ["admin", "hr"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    
+    result = rebuild_expense_counters()
+    return {
+        "message": "Expense totals rebuilt successfully",
+        "counters": result["rebuilt"],
+        "removed": result["removed"],
+        "skipped": result["skipped"]
+    }
+
 # Health check
 @app.get("/api/health")
 async def health_check():